@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
 from glob import glob
-from os import getenv
+from os import getenv, open as os_open, pipe, pread, read, set_blocking, O_RDONLY
 from pathlib import Path
-from signal import signal, SIGTERM
+from re import compile as re_compile, ASCII
+from signal import getsignal, set_wakeup_fd, signal, SIGINT, SIG_IGN, SIGTERM
+from socketserver import ThreadingMixIn
 from sys import exit
-from threading import Thread
+from threading import Condition, Thread
 from time import sleep
+from wsgiref.simple_server import make_server, WSGIServer
 
 # Third party imports
 from dotenv import load_dotenv
@@ -14,59 +17,90 @@ import hug
 from falcon import HTTP_400
 from gpiozero import OutputDevice
 
-# Global constants
+# Global constants (probe is resolved and opened once; reads use the fd)
 try:
-    PROBE_PATH = glob('/sys/bus/w1/devices/28*/temperature')[0]
-except IndexError:
+    PROBE_FD = os_open(glob('/sys/bus/w1/devices/28*/temperature')[0], O_RDONLY)
+except (IndexError, OSError):
     exit('Error: Unable to open temperature probe')
 
 STATE_PATH = Path('state')
 DEFAULT_GOAL_TEMP = 90
 MAXIMUM_TEMP = 104
+TEMP_DEADBAND = 0.5
+# ASCII so \s and \d only match what float() accepts
+TEMP_PATTERN = re_compile(r'\A\s*-?(?:\d+\.?\d*|\.\d+)\s*\Z', ASCII)
 
-# Add CORS middleware
-api = hug.API(__name__)
-api.http.add_middleware(hug.middleware.CORSMiddleware(api))
-
-# Set up authentication
+# Load configuration
 load_dotenv()
 USERNAME = getenv('USERNAME')
 PASSWORD = getenv('PASSWORD')
+PORT = int(getenv('PORT', 8000))
+CORS = getenv('CORS', '1') != '0'
+
+# Add CORS middleware (skipped entirely when served same-origin)
+api = hug.API(__name__)
+if CORS:
+    api.http.add_middleware(hug.middleware.CORSMiddleware(api))
+
+# Set up authentication
 authentication = hug.authentication.basic(hug.authentication.verify(USERNAME, PASSWORD))
 
 
-def is_float(string):
-    try:
-        float(string)
-        return True
-    except ValueError:
+# Handle each request on its own thread so concurrent pollers don't queue up
+# behind one another (hug's dev server is single-threaded)
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+# Set when run as a script so wait_for_stop can shut the server down
+server = None
+
+
+def should_heat(current_temp, goal_temp, heater_on):
+    if goal_temp > MAXIMUM_TEMP:
         return False
 
+    # Deadband around goal keeps the relay from chattering on probe noise,
+    # but never heat past the maximum
+    if heater_on:
+        return current_temp <= goal_temp + TEMP_DEADBAND and current_temp < MAXIMUM_TEMP
+    else:
+        return current_temp < goal_temp - TEMP_DEADBAND
+
 
 @hug.object
 class HotTub:
     def __init__(self):
         self.running = True
-        self.current_temp = 0
+        goal_temp = DEFAULT_GOAL_TEMP
 
         # Restore last set temperature from file (if exists)
         if STATE_PATH.is_file():
             with open(STATE_PATH) as f:
                 try:
-                    self.goal_temp = float(f.read())
-                # Set default if state file is empty
+                    goal_temp = float(f.read())
+                # Keep default if state file is empty
                 except ValueError:
-                    self.goal_temp = DEFAULT_GOAL_TEMP
-        else:
-            self.goal_temp = DEFAULT_GOAL_TEMP
-
-        # Relay I/O
-        self.circulation_pump_relay = OutputDevice(17)
-        self.jets_pump_relay = OutputDevice(22)
+                    pass
+
+        # (current_temp, goal_temp) is swapped as a single immutable tuple so
+        # readers always see a coherent pair without locking; writers take
+        # the condition's lock to avoid clobbering each other's half of the
+        # pair and notify it to wake manage_temp
+        self.temps = (0, goal_temp)
+        self.temps_changed = Condition()
+
+        # Responses are rebuilt when temps change rather than per request
+        self.current_temp_response = {'result': '0'}
+        self.goal_temp_response = {'result': goal_temp}
+
+        # Relay I/O (circulation pump always on, driven high at setup)
+        self.circulation_pump_relay = OutputDevice(17, initial_value=True)
+        # Jets can only be toggled by an authenticated caller, so skip
+        # claiming the pin at all when no credentials are configured
+        self.jets_pump_relay = OutputDevice(22) if USERNAME else None
         self.heater_relay = OutputDevice(27)
-
-        # Circulation pump always on
-        self.circulation_pump_relay.on()
+        self.heater_on = False
 
         # Background threads
         self.read_temp_thread = Thread(target=self.read_temp)
@@ -74,75 +108,134 @@ class HotTub:
         self.read_temp_thread.start()
         self.manage_temp_thread.start()
 
-        # Handle SIGTERM
-        signal(SIGTERM, self.stop)
+        # Handle SIGTERM/SIGINT outside of signal context: the handlers are
+        # no-ops and Python writes the signal number to the wakeup pipe instead
+        stop_read_fd, stop_write_fd = pipe()
+        set_blocking(stop_write_fd, False)
+        set_wakeup_fd(stop_write_fd)
+        signal(SIGTERM, lambda signum, frame: None)
+        # Leave SIGINT ignored if it was (e.g. started in the background)
+        if getsignal(SIGINT) is not SIG_IGN:
+            signal(SIGINT, lambda signum, frame: None)
+
+        self.wait_for_stop_thread = Thread(target=self.wait_for_stop, args=(stop_read_fd,), daemon=True)
+        self.wait_for_stop_thread.start()
 
     @hug.object.get('/temp')
     def get_current_temp(self):
-        return {'result': f'{self.current_temp:.4g}'}
+        return self.current_temp_response
 
     @hug.object.post('/temp', requires=authentication)
     def set_goal_temp(self, data, response):
-        if data and is_float(data):
-            self.goal_temp = float(data)
+        # Validate up front so bad input never goes through float()'s exception path
+        if not isinstance(data, str) or not TEMP_PATTERN.match(data):
+            response.status = HTTP_400
+            return
 
-            # Save temperature to file
+        goal_temp = float(data)
+
+        with self.temps_changed:
+            self.temps = (self.temps[0], goal_temp)
+            self.goal_temp_response = {'result': goal_temp}
+            self.temps_changed.notify()
+
+            # Save temperature to file (under the lock so concurrent POSTs
+            # can't leave the file out of step with temps)
             with open(STATE_PATH, 'w') as f:
-                f.write(data)
-        else:
-            response.status = HTTP_400
+                f.write(data.strip())
 
     @hug.object.get('/goal-temp')
     def get_goal_temp(self):
-        return {'result': self.goal_temp}
+        return self.goal_temp_response
 
     @hug.object.get('/jets')
     def get_jets_active(self):
-        return {'result': bool(self.jets_pump_relay.value)}
+        return {'result': self.jets_pump_relay is not None and bool(self.jets_pump_relay.value)}
 
     @hug.object.post('/jets', requires=authentication)
-    def toggle_jets_active(self):
+    def toggle_jets_active(self, response):
+        if self.jets_pump_relay is None:
+            response.status = HTTP_400
+            return
+
         self.jets_pump_relay.toggle()
         return self.get_jets_active()
 
     def read_temp(self):
-        def convert_to_fahrenheit(temp):
-            return (temp * 9/5) + 32
-
         # Update temperature in loop
         while self.running:
-            with open(PROBE_PATH) as f:
-                raw_temp = f.read().rstrip()
-
-            if raw_temp:
-                # Split string into float
-                celsius = float(raw_temp) / 1000
-                self.current_temp = convert_to_fahrenheit(celsius)
-            else:
-                # If temp can't be read, set higher than max to disable heater
-                self.current_temp = MAXIMUM_TEMP + 1
+            # Probe reports integer millidegrees Celsius; int() skips the
+            # trailing newline itself. pread from offset 0 is a single
+            # syscall per sample and releases the GIL while the kernel
+            # waits on the probe
+            try:
+                celsius = int(pread(PROBE_FD, 16, 0)) / 1000
+                current_temp = celsius * 1.8 + 32
+            # If temp can't be read, set higher than max to disable heater
+            except (OSError, ValueError):
+                current_temp = MAXIMUM_TEMP + 1
+
+            with self.temps_changed:
+                goal_temp = self.temps[1]
+                self.temps = (current_temp, goal_temp)
+
+                # Only wake manage_temp if the heater needs to switch
+                if should_heat(current_temp, goal_temp, self.heater_on) != self.heater_on:
+                    self.temps_changed.notify()
+
+            self.current_temp_response = {'result': f'{current_temp:.4g}'}
+
+            # Probe conversion takes ~750 ms, so faster reads are stale
+            sleep(1)
 
     def manage_temp(self):
-        while self.running:
-            if self.current_temp < self.goal_temp <= MAXIMUM_TEMP:
-                self.heater_relay.on()
-            else:
-                self.heater_relay.off()
+        with self.temps_changed:
+            while self.running:
+                heat = should_heat(*self.temps, self.heater_on)
 
-            sleep(1)
+                # Only touch the relay on transitions
+                if heat != self.heater_on:
+                    if heat:
+                        self.heater_relay.on()
+                    else:
+                        self.heater_relay.off()
+
+                    self.heater_on = heat
+
+                # Sleep until temps change, re-checking periodically as a safeguard
+                self.temps_changed.wait(timeout=5)
 
-    def stop(self, signum, frame):
+    def wait_for_stop(self, fd):
+        # Block until SIGTERM/SIGINT arrives on the wakeup pipe (Python writes
+        # every handled signal there)
+        while read(fd, 1)[0] not in (SIGTERM, SIGINT):
+            pass
+
+        self.stop()
+
+        # End serve_forever in the main thread so the process exits
+        if server is not None:
+            server.shutdown()
+
+    def stop(self):
         self.running = False
 
+        # Wake manage_temp so it sees running is cleared
+        with self.temps_changed:
+            self.temps_changed.notify()
+
         # Join threads
         self.read_temp_thread.join()
         self.manage_temp_thread.join()
 
         # Turn off relays
         self.circulation_pump_relay.off()
-        self.jets_pump_relay.off()
+        if self.jets_pump_relay is not None:
+            self.jets_pump_relay.off()
         self.heater_relay.off()
 
-        # Exit program
-        exit()
 
+if __name__ == '__main__':
+    # Single process only: HotTub owns the GPIO pins and probe
+    with make_server('', PORT, api.http.server(), server_class=ThreadingWSGIServer) as server:
+        server.serve_forever()